@@ -1,78 +1,347 @@
+import os
+
+# As páginas são processadas em paralelo, cada uma em uma thread com seu próprio Tesseract (tesserocr); o OpenMP da
+# libtesseract e o OpenBLAS do numpy limitam-se a uma thread para não disputar os núcleos com as demais páginas.
+# Essas bibliotecas só leem as variáveis ao serem carregadas, por isso elas vêm antes dos demais imports.
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+os.environ.setdefault("OPENBLAS_NUM_THREADS", "1")
+
 import streamlit as st
 import pytesseract
-from pdf2image import convert_from_path
+import pypdfium2 as pdfium
+from pdf2image import convert_from_path, pdfinfo_from_path
 import cv2
 import numpy as np
 import tempfile
-import os
+import contextlib
 import re
 import logging
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+try:
+    import tesserocr
+except ImportError:  # tesserocr exige a libtesseract instalada; sem ela, usa-se o pytesseract
+    tesserocr = None
 
 # Configuração de logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+logging.getLogger("pdf2image").setLevel(logging.WARNING)
+logging.getLogger("PIL").setLevel(logging.WARNING)
 
 # Caminho para os dados do Tesseract (ajuste conforme necessário)
 if "TESSDATA_PREFIX" not in os.environ:
     os.environ["TESSDATA_PREFIX"] = "/usr/share/tesseract-ocr/4.00/tessdata/"
-    logger.info(f"TESSDATA_PREFIX não configurado via variável de ambiente, usando padrão: {os.environ['TESSDATA_PREFIX']}")
+    logger.info("TESSDATA_PREFIX não configurado via variável de ambiente, usando padrão: %s", os.environ['TESSDATA_PREFIX'])
+
+# Pelo mesmo motivo das variáveis do OpenMP, cada operação do OpenCV roda em uma única thread (a configuração vale para o processo todo).
+cv2.setUseOptimized(True)
+cv2.setNumThreads(1)
+
+OCR_LANG = "por+eng"
+
+# Processos do pdftoppm usados na renderização (o pdf2image ainda limita ao número de páginas). A renderização
+# roda ao mesmo tempo que o OCR, então fica com cerca de um quarto dos núcleos.
+PDF_RENDER_THREADS = max(1, min((os.cpu_count() or 1) // 4, 8))
+
+# Páginas renderizadas por chamada ao pdf2image, que executa pdfinfo e pdftoppm -v antes de cada lote;
+# independe do número de processos para que o custo fixo não se repita a cada página em máquinas pequenas.
+PDF_RENDER_BATCH_PAGES = max(PDF_RENDER_THREADS, 4)
+
+# Número de páginas processadas em paralelo (padrão: os núcleos que sobram da renderização)
+OCR_CONCURRENCY = max(1, int(os.environ.get("OCR_CONCURRENCY", (os.cpu_count() or 1) - PDF_RENDER_THREADS)))
+
+# Mínimo de caracteres (exceto espaços) para usar a camada de texto embutida no PDF em vez do OCR
+MIN_EMBEDDED_TEXT_CHARS = 200
+
+# DPI inicial do controle de resolução, configurável pela variável de ambiente OCR_DPI (limitado a 200-400)
+DEFAULT_DPI = min(400, max(200, int(os.environ.get("OCR_DPI", 300))))
 
+# Quantidade de textos de página mantidos no cache de OCR em memória
+PAGE_TEXT_CACHE_SIZE = 512
 
-def preprocess_image(image, binarization_threshold=31, denoise_strength=10):
-    """Melhora a qualidade da imagem para OCR."""
+# Métodos de binarização disponíveis: o Otsu (limiar global) é bem mais barato e suficiente para PDFs
+# renderizados; o adaptativo lida melhor com iluminação irregular de digitalizações.
+BINARIZATION_METHODS = {"otsu": "Otsu (global)", "adaptive": "Adaptativo (local)"}
+
+# DPI usado na nova tentativa quando o texto extraído não passa na validação
+RETRY_DPI = 400
+
+# Correções de formato aplicadas ao texto extraído de NFS-e
+_TEXT_CORRECTIONS = [
+    (re.compile(r'(\d{2})[\.]?(\d{3})[\.]?(\d{3})[/]?0001[-]?(\d{2})'), r'\1.\2.\3/0001-\4'),  # CNPJ
+    (re.compile(r'(\d{2})[\/.-](\d{2})[\/.-](\d{4})'), r'\1/\2/\3'),  # Datas
+    (re.compile(r'R\$ (\d+)[,.](\d{2})'), r'R$\1,\2')  # Valores
+]
+
+# Tabela para remover acentos do português em uma única passada de str.translate
+_ACCENT_MAP = str.maketrans("áàâãäéèêëíìîïóòôõöúùûüç", "aaaaaeeeeiiiiooooouuuuc")
+
+def _normalize_for_match(text):
+    """Normaliza o texto para comparação: minúsculas, sem acentos e com espaços simples."""
+    return " ".join(text.casefold().translate(_ACCENT_MAP).split())
+
+# Informações que uma NFS-e válida deve conter (comparadas após _normalize_for_match)
+_REQUIRED_TERMS = [
+    _normalize_for_match(term) for term in (
+        'NOTA FISCAL DE SERVIÇOS ELETRÔNICA',
+        'CNPJ',
+        'Valor Total',
+        'Data e Hora de Emissão'
+    )
+]
+
+
+@st.cache_resource
+def get_thread_state():
+    """Retorna o estado por thread do OCR (buffers de página e instâncias do tesserocr), compartilhado entre execuções."""
+    # As threads do pool sobrevivem às reexecuções do script, mas as variáveis do módulo não; por isso o
+    # threading.local fica no cache, e é obtido na thread do script e repassado às tarefas do pool.
+    return threading.local()
+
+def _thread_buffer(thread_state, name, shape):
+    """Retorna um buffer uint8 da thread atual, reaproveitado entre páginas de mesmo tamanho."""
+    buffers = vars(thread_state).setdefault("page_buffers", {})
+    buffer = buffers.get(name)
+    if buffer is None or buffer.shape != shape:
+        buffer = buffers[name] = np.empty(shape, np.uint8)
+    return buffer
+
+def preprocess_image(image, binarization_threshold=31, denoise_strength=10, high_quality_denoise=False, binarization_method="otsu", thread_state=None):
+    """Melhora a qualidade da imagem para OCR. Imagens já em tons de cinza não passam por conversão de cor.
+
+    Com thread_state (de get_thread_state), o resultado é escrito em buffers da thread atual e só é válido até a próxima chamada nela.
+    """
     try:
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        denoised = cv2.fastNlMeansDenoising(gray, h=denoise_strength, templateWindowSize=7, searchWindowSize=21)
-        thresh = cv2.adaptiveThreshold(denoised, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, binarization_threshold, 2)
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+        denoised = _thread_buffer(thread_state, "denoised", gray.shape) if thread_state is not None else None
+        thresh = _thread_buffer(thread_state, "thresh", gray.shape) if thread_state is not None else None
+        if high_quality_denoise:
+            # Non-local means: melhor para digitalizações ruidosas, mas muito mais lento
+            denoised = cv2.fastNlMeansDenoising(gray, dst=denoised, h=denoise_strength, templateWindowSize=7, searchWindowSize=21)
+        else:
+            sigma = denoise_strength * 2.5
+            denoised = cv2.bilateralFilter(gray, 5, sigma, sigma, dst=denoised)
+        if binarization_method == "adaptive":
+            # Média simples da vizinhança (filtro de caixa), bem mais barata que a ponderação gaussiana;
+            # o tamanho do bloco precisa ser ímpar, então valores pares do slider são arredondados para cima
+            block_size = binarization_threshold | 1
+            thresh = cv2.adaptiveThreshold(denoised, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, block_size, 2, dst=thresh)
+        else:
+            _, thresh = cv2.threshold(denoised, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU, dst=thresh)
         return thresh
     except Exception as e:
-        logger.error(f"Erro no pré-processamento da imagem: {e}")
-        st.error(f"Erro no pré-processamento da imagem: {e}. Verifique os parâmetros ou a imagem.")
+        logger.error("Erro no pré-processamento da imagem: %s", e)
         return None
 
-def extract_text_from_pdf(pdf_path, dpi=300, psm=6, oem=3, binarization_threshold=31, denoise_strength=10, poppler_path="/usr/bin"):
-    """Extrai texto de todas as páginas de um PDF."""
+def _get_tesserocr_api(thread_state, oem):
+    """Retorna a instância do tesserocr da thread atual para o OEM informado."""
+    # As instâncias ficam no estado por thread, que sobrevive às reexecuções do script,
+    # de modo que o modelo de idioma é carregado uma única vez por thread do pool.
+    apis = vars(thread_state).setdefault("tesserocr_apis", {})
+    api = apis.get(oem)
+    if api is None:
+        api = tesserocr.PyTessBaseAPI(path=os.environ["TESSDATA_PREFIX"], lang=OCR_LANG, oem=oem)
+        api.SetVariable("preserve_interword_spaces", "1")
+        apis[oem] = api
+    return api
+
+def image_to_string(image, thread_state, psm=6, oem=3):
+    """Aplica OCR em uma imagem binarizada, usando o tesserocr (da thread atual, em thread_state) quando disponível."""
+    if tesserocr is not None:
+        api = _get_tesserocr_api(thread_state, oem)
+        api.SetPageSegMode(psm)
+        height, width = image.shape
+        api.SetImageBytes(np.ascontiguousarray(image).tobytes(), width, height, 1, width)
+        return api.GetUTF8Text()
+    custom_config = f'--oem {oem} --psm {psm} -c preserve_interword_spaces=1 -l {OCR_LANG}'
+    return pytesseract.image_to_string(image, config=custom_config)
+
+@st.cache_resource
+def get_ocr_pool():
+    """Retorna o pool de threads de OCR, criado uma única vez e compartilhado entre execuções e sessões."""
+    return ThreadPoolExecutor(max_workers=OCR_CONCURRENCY, thread_name_prefix="ocr")
+
+@st.cache_resource
+def get_page_text_cache():
+    """Retorna o cache LRU de textos de OCR por página (e sua trava), compartilhado entre execuções e sessões."""
+    return OrderedDict(), threading.Lock()
+
+def _cached_image_to_string(image, psm, oem, page_cache, thread_state):
+    """Aplica OCR na imagem, reaproveitando o texto de uma página binarizada idêntica já processada."""
+    cache, lock = page_cache
+    key = (hashlib.blake2b(image, digest_size=16).digest(), image.shape, psm, oem)
+    with lock:
+        text = cache.get(key)
+        if text is not None:
+            cache.move_to_end(key)
+            return text
+    text = image_to_string(image, thread_state, psm=psm, oem=oem)
+    with lock:
+        cache[key] = text
+        if len(cache) > PAGE_TEXT_CACHE_SIZE:
+            cache.popitem(last=False)
+    return text
+
+def _ocr_page(page_path, thread_state, psm=6, oem=3, binarization_threshold=31, denoise_strength=10, high_quality_denoise=False, binarization_method="otsu", page_cache=None):
+    """Carrega, pré-processa e aplica OCR em uma única página renderizada. Retorna None se o pré-processamento falhar."""
     try:
-        images = convert_from_path(pdf_path, dpi=dpi, poppler_path=poppler_path)
-        text_parts = []
-        for i, image in enumerate(images):
-            logger.info(f"Processando página {i+1}/{len(images)}")
-            processed_image = preprocess_image(np.array(image), binarization_threshold=binarization_threshold, denoise_strength=denoise_strength)
-            if processed_image is not None:
-                custom_config = f'--oem {oem} --psm {psm} -c preserve_interword_spaces=1 -l por+eng'
-                text = pytesseract.image_to_string(processed_image, config=custom_config)
-                text_parts.append(text)
-            else:
-                logger.warning(f"Pré-processamento da página {i+1} falhou, pulando para a próxima página.")
-        return "\n".join(text_parts)
+        gray = cv2.imread(page_path, cv2.IMREAD_GRAYSCALE)
+    finally:
+        # A página já está na memória: o arquivo é removido para que o espaço temporário não acumule o documento inteiro
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(page_path)
+    if gray is None:
+        logger.error("Não foi possível ler a página renderizada: %s", page_path)
+        return None
+    processed_image = preprocess_image(gray, binarization_threshold=binarization_threshold, denoise_strength=denoise_strength, high_quality_denoise=high_quality_denoise, binarization_method=binarization_method, thread_state=thread_state)
+    if processed_image is None:
+        return None
+    if page_cache is None:
+        return image_to_string(processed_image, thread_state, psm=psm, oem=oem)
+    return _cached_image_to_string(processed_image, psm, oem, page_cache, thread_state)
+
+@st.cache_resource
+def get_pdfium_lock():
+    """Retorna a trava que serializa as chamadas ao PDFium, compartilhada entre execuções e sessões."""
+    # O PDFium não pode ser usado por várias threads ao mesmo tempo, nem em documentos diferentes,
+    # e cada sessão do Streamlit executa o script em sua própria thread.
+    return threading.Lock()
+
+def extract_embedded_text(pdf_bytes):
+    """Extrai a camada de texto embutida de cada página do PDF. Retorna None se o PDF não puder ser lido."""
+    try:
+        # Páginas e camadas de texto são fechadas explicitamente, ainda com a trava, para que nenhum
+        # objeto do PDFium seja liberado depois pelo coletor de lixo em outra thread.
+        with get_pdfium_lock():
+            pdf = pdfium.PdfDocument(pdf_bytes)
+            try:
+                page_texts = []
+                for page in pdf:
+                    try:
+                        textpage = page.get_textpage()
+                        try:
+                            page_texts.append(textpage.get_text_range().replace("\r\n", "\n"))
+                        finally:
+                            textpage.close()
+                    finally:
+                        page.close()
+                return page_texts
+            finally:
+                pdf.close()
     except Exception as e:
-        logger.error(f"Erro na extração de texto do PDF: {e}")
-        st.error(f"Erro na extração de texto do PDF: {e}. Verifique se o arquivo PDF é válido.")
-        return ""
+        logger.warning("Não foi possível ler a camada de texto do PDF: %s", e)
+        return None
+
+def _has_embedded_text(text):
+    """Indica se o texto embutido de uma página é suficiente para dispensar o OCR."""
+    return len("".join(text.split())) >= MIN_EMBEDDED_TEXT_CHARS
+
+def _page_ranges(page_numbers, max_length=None):
+    """Agrupa números de página consecutivos em intervalos (primeira, última) de até max_length páginas."""
+    ranges = []
+    for number in page_numbers:
+        if ranges and ranges[-1][1] == number - 1 and (max_length is None or number - ranges[-1][0] < max_length):
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ranges
+
+def extract_text_from_pdf(pdf_bytes, dpi=300, psm=6, oem=3, binarization_threshold=31, denoise_strength=10, high_quality_denoise=False, binarization_method="otsu", poppler_path="/usr/bin", force_ocr=False):
+    """Extrai texto de todas as páginas de um PDF a partir do seu conteúdo. Retorna o texto e o número de páginas com OCR.
+
+    Páginas com camada de texto embutida usam esse texto diretamente; apenas as demais passam pelo OCR.
+    Erros na renderização ou no OCR são propagados, para que resultados de falhas não fiquem no cache.
+    """
+    page_texts = None if force_ocr else extract_embedded_text(pdf_bytes)
+    if page_texts is None:
+        # Sem camada de texto legível: todas as páginas passam pelo OCR (a contagem vem do pdfinfo, abaixo)
+        ocr_page_numbers = None
+    else:
+        ocr_page_numbers = [i + 1 for i, text in enumerate(page_texts) if not _has_embedded_text(text)]
+        logger.info("%d de %d página(s) com camada de texto embutida", len(page_texts) - len(ocr_page_numbers), len(page_texts))
+    results = []
+    if ocr_page_numbers is None or ocr_page_numbers:
+        # O Poppler já renderiza em tons de cinza, evitando conversões de cor página a página, e grava as
+        # páginas em disco para que cada uma só seja carregada na memória pela thread que a processa.
+        with tempfile.TemporaryDirectory() as output_folder:
+            # O PDF é gravado uma única vez: o convert_from_bytes faria uma nova cópia em disco a cada lote
+            pdf_path = os.path.join(output_folder, "documento.pdf")
+            with open(pdf_path, "wb") as pdf_file:
+                pdf_file.write(pdf_bytes)
+            if ocr_page_numbers is None:
+                ocr_page_numbers = list(range(1, pdfinfo_from_path(pdf_path, poppler_path=poppler_path)["Pages"] + 1))
+            ocr_page = partial(_ocr_page, psm=psm, oem=oem, binarization_threshold=binarization_threshold, denoise_strength=denoise_strength, high_quality_denoise=high_quality_denoise, binarization_method=binarization_method, page_cache=get_page_text_cache(), thread_state=get_thread_state())
+            # Tanto o tesserocr quanto o subprocesso do pytesseract liberam o GIL, então threads bastam para ocupar todos os núcleos.
+            logger.info("Processando %d página(s) em paralelo", len(ocr_page_numbers))
+            pool = get_ocr_pool()
+            futures = []
+            # As páginas são renderizadas em lotes de PDF_RENDER_BATCH_PAGES páginas e cada lote vai para o OCR
+            # assim que fica pronto, sobrepondo a renderização do lote seguinte ao reconhecimento do anterior.
+            try:
+                for first_page, last_page in _page_ranges(ocr_page_numbers, max_length=PDF_RENDER_BATCH_PAGES):
+                    page_paths = convert_from_path(pdf_path, dpi=dpi, poppler_path=poppler_path, grayscale=True, thread_count=PDF_RENDER_THREADS, first_page=first_page, last_page=last_page, output_folder=output_folder, paths_only=True)
+                    if len(page_paths) != last_page - first_page + 1:
+                        # O pdf2image ignora o código de saída do pdftoppm: uma página que falha é omitida e
+                        # os textos das seguintes iriam para as posições erradas
+                        raise RuntimeError(f"Falha ao renderizar as páginas {first_page} a {last_page} do PDF ({len(page_paths)} imagem(ns) gerada(s)).")
+                    futures += [pool.submit(ocr_page, page_path) for page_path in page_paths]
+                results = [future.result() for future in futures]
+            finally:
+                # Em caso de erro ou interrupção da execução, as páginas ainda na fila não devem tentar ler
+                # arquivos de uma pasta temporária prestes a ser removida (futuros concluídos não são afetados)
+                for future in futures:
+                    future.cancel()
+    if page_texts is None:
+        page_texts = results
+    else:
+        for page_number, text in zip(ocr_page_numbers, results):
+            page_texts[page_number - 1] = text
+    text_parts = []
+    has_content = False
+    for i, text in enumerate(page_texts):
+        if text is not None:
+            if text and not text.isspace():
+                has_content = True
+            text_parts.append(text)
+        else:
+            logger.warning("Pré-processamento da página %d falhou, pulando para a próxima página.", i+1)
+            st.error(f"Erro no pré-processamento da página {i+1}. Verifique os parâmetros ou a imagem.")
+    # Páginas só com espaços não contam como texto extraído
+    return ("\n".join(text_parts) if has_content else ""), len(results)
+
+# Cache só em memória: no disco o Streamlit não aplica max_entries nem ttl, e o texto das notas ficaria lá indefinidamente
+@st.cache_data(show_spinner=False, max_entries=64, ttl=24 * 3600)
+def ocr_pdf_bytes(pdf_bytes, dpi=300, psm=6, oem=3, binarization_threshold=31, denoise_strength=10, high_quality_denoise=False, binarization_method="otsu", poppler_path="/usr/bin", force_ocr=False):
+    """Extrai o texto de um PDF (junto do número de páginas com OCR), reaproveitando resultados já calculados para o mesmo arquivo e configuração."""
+    return extract_text_from_pdf(
+        pdf_bytes,
+        dpi=dpi,
+        psm=psm,
+        oem=oem,
+        binarization_threshold=binarization_threshold,
+        denoise_strength=denoise_strength,
+        high_quality_denoise=high_quality_denoise,
+        binarization_method=binarization_method,
+        poppler_path=poppler_path,
+        force_ocr=force_ocr
+    )
 
 def correct_text_format(text):
     """Corrige formatos comuns de texto em NFS-e."""
-    corrections = {
-        r'(\d{2})[\.]?(\d{3})[\.]?(\d{3})[/]?0001[-]?(\d{2})': r'\1.\2.\3/0001-\4',  # CNPJ
-        r'(\d{2})[\/.-](\d{2})[\/.-](\d{4})': r'\1/\2/\3',  # Datas
-        r'R\$ (\d+)[,.](\d{2})': r'R$\1,\2'  # Valores
-    }
-    for pattern, replacement in corrections.items():
-        text = re.sub(pattern, replacement, text)
+    for pattern, replacement in _TEXT_CORRECTIONS:
+        text = pattern.sub(replacement, text)
     return text
 
 def validate_extracted_text(text):
     """Valida se o texto extraído contém informações chave."""
-    required_patterns = [
-        r'NOTA FISCAL DE SERVIÇOS ELETRÔNICA',
-        r'CNPJ',
-        r'Valor Total',
-        r'Data e Hora de Emissão'
-    ]
-    for pattern in required_patterns:
-        if not re.search(pattern, text, re.IGNORECASE):
-            return False
-    return True
+    normalized_text = _normalize_for_match(text)
+    return all(term in normalized_text for term in _REQUIRED_TERMS)
 
 def main():
     st.title("Extração de Texto de NFS-e")
@@ -82,35 +351,68 @@ def main():
 
     # Sidebar para configurações avançadas
     with st.sidebar.expander("Configurações de Imagem", expanded=False):
-        dpi = st.slider("DPI da imagem", 200, 400, 300, 50, help="Resolução da imagem para OCR. Aumente para PDFs de baixa qualidade.")
-        binarization_threshold = st.slider("Limiar de binarização", 10, 50, 31, 1, help="Ajuste para melhorar o contraste do texto.")
+        dpi = st.slider("DPI da imagem", 200, 400, DEFAULT_DPI, 50, help="Resolução da imagem para OCR. Aumente para PDFs de baixa qualidade.")
+        binarization_method = st.selectbox("Método de binarização", list(BINARIZATION_METHODS), format_func=BINARIZATION_METHODS.get, help="Otsu é mais rápido e adequado a PDFs digitais; o adaptativo lida melhor com digitalizações de iluminação irregular.")
+        binarization_threshold = st.slider("Limiar de binarização", 10, 50, 31, 1, help="Tamanho da vizinhança do método adaptativo. Ajuste para melhorar o contraste do texto.")
         denoise_strength = st.slider("Intensidade de remoção de ruído", 5, 20, 10, 1, help="Reduz ruídos na imagem, útil para PDFs escaneados.")
+        high_quality_denoise = st.checkbox("Remoção de ruído de alta qualidade", False, help="Usa o filtro non-local means, mais preciso em digitalizações ruidosas, porém bem mais lento.")
+        retry_on_failure = st.checkbox("Repetir com outras configurações se a validação falhar", True, help=f"Quando o texto não passa na validação, tenta novamente com binarização adaptativa e depois com {RETRY_DPI} DPI.")
 
     with st.sidebar.expander("Configurações de OCR", expanded=False):
         psm = st.slider("PSM (Modo de Segmentação de Página)", 3, 13, 6, 1, help="Define como o Tesseract segmenta a página. Modo 6 é bom para blocos de texto.")
         oem = st.slider("OEM (Modo de Motor OCR)", 1, 3, 3, 1, help="Define o motor do Tesseract. Modo 3 é o motor neural mais preciso.")
+        force_ocr = st.checkbox("Forçar OCR", False, help="Ignora o texto embutido no PDF e aplica OCR em todas as páginas.")
 
     poppler_path_config = st.sidebar.text_input("Caminho Poppler (opcional)", "/usr/bin", help="Informe o caminho para o executável do Poppler se não estiver no PATH do sistema.")
 
     if uploaded_file:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as temp_file:
-            temp_file.write(uploaded_file.read())
-            pdf_path = temp_file.name
-
-        with st.spinner("Extraindo texto..."):
-            extracted_text = extract_text_from_pdf(
-                pdf_path,
-                dpi=dpi,
-                psm=psm,
-                oem=oem,
-                binarization_threshold=binarization_threshold,
-                denoise_strength=denoise_strength,
-                poppler_path=poppler_path_config
-            )
-            corrected_text = correct_text_format(extracted_text)
+        pdf_bytes = uploaded_file.getvalue()
+        ocr_settings = dict(
+            psm=psm,
+            oem=oem,
+            denoise_strength=denoise_strength,
+            high_quality_denoise=high_quality_denoise,
+            poppler_path=poppler_path_config,
+            force_ocr=force_ocr
+        )
+        # Tentativas em ordem crescente de custo; as seguintes só rodam se a anterior não passar na validação
+        attempts = [dict(dpi=dpi, binarization_method=binarization_method)]
+        if retry_on_failure:
+            if binarization_method != "adaptive":
+                attempts.append(dict(dpi=dpi, binarization_method="adaptive"))
+            if dpi < RETRY_DPI:
+                attempts.append(dict(dpi=RETRY_DPI, binarization_method="adaptive"))
+        for attempt in attempts:
+            # O limiar só é usado pelo método adaptativo; com Otsu ele fica fora da chave do cache,
+            # para que mover o controle não refaça a extração do documento
+            attempt["binarization_threshold"] = binarization_threshold if attempt["binarization_method"] == "adaptive" else None
+
+        for i, attempt in enumerate(attempts):
+            spinner_text = "Extraindo texto..." if i == 0 else "Validação falhou, extraindo novamente com outras configurações..."
+            with st.spinner(spinner_text):
+                try:
+                    attempt_text, ocr_page_count = ocr_pdf_bytes(pdf_bytes, **attempt, **ocr_settings)
+                except Exception as e:
+                    # Falhas não ficam no cache: enviar o arquivo de novo repete a extração
+                    logger.error("Erro na extração de texto do PDF: %s", e)
+                    st.error(f"Erro na extração de texto do PDF: {e}. Verifique se o arquivo PDF é válido.")
+                    if i == 0:
+                        return
+                    # Nas novas tentativas, mantém-se o resultado da primeira
+                    break
+                attempt_corrected_text = correct_text_format(attempt_text)
+                is_valid = validate_extracted_text(attempt_corrected_text)
+            # O resultado da primeira tentativa só é substituído por um que passe na validação
+            if i == 0 or is_valid:
+                extracted_text, corrected_text = attempt_text, attempt_corrected_text
+            if is_valid:
+                break
+            if not ocr_page_count:
+                # Todo o texto veio da camada embutida: outras configurações de imagem não mudariam o resultado
+                break
 
         if extracted_text:
-            if validate_extracted_text(corrected_text):
+            if is_valid:
                 st.success("Texto extraído e validado com sucesso!")
             else:
                 st.warning("O texto foi extraído, mas a validação falhou. Verifique o conteúdo. Pode não ser uma NFS-e ou a extração pode ter falhado parcialmente.")
@@ -118,7 +420,5 @@ def main():
         else:
             st.error("Falha na extração do texto. Verifique o arquivo PDF e as configurações.")
 
-        os.unlink(pdf_path)
-
 if __name__ == "__main__":
     main()